@@ -1,18 +1,23 @@
+import copy
 import hashlib
 import json
 import logging
 import phonenumbers
 import requests
+import time
 import uuid
 from collections import OrderedDict
+from contextlib import contextmanager
 from django import forms
 from django.conf import settings
 from django.core.cache import cache
+from django.db import transaction
 from django.http import HttpRequest
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
+from functools import lru_cache
 from phonenumber_field.formfields import PhoneNumberField
 from pretix.base.forms import SecretKeySettingsField
 from pretix.base.forms.questions import (
@@ -23,11 +28,107 @@ from pretix.base.models import Event, OrderPayment, OrderRefund
 from pretix.base.payment import BasePaymentProvider, PaymentException
 from pretix.base.settings import SettingsSandbox
 from pretix.presale.views.cart import cart_session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
 
-from .tasks import check_payment
+from .tasks import check_payment, confirm_payment
+
+try:
+    import orjson
+
+    def _json_loads(s):
+        return orjson.loads(s)
+
+    def _json_dumps(o):
+        return orjson.dumps(o).decode()
+
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+try:
+    import h2  # NOQA
+    import httpx
+except ImportError:
+    httpx = None
 
 logger = logging.getLogger(__name__)
+
+# All calls go to *.momodeveloper.mtn.com, so a shared session with a keep-alive
+# connection pool avoids a new TCP+TLS handshake for every API call.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        # Retrying POSTs is safe here: /requesttopay and /refund carry a
+        # client-generated X-Reference-Id, so MTN deduplicates repeats, and the
+        # token POST has no side effects.
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+        ),
+    ),
+)
+# (connect, read) timeouts so a stuck MTN endpoint cannot hang a worker forever
+REQUEST_TIMEOUT = (3.05, 10)
+
+_REQUEST_EXCEPTIONS = (requests.exceptions.RequestException,)
+if httpx is not None:
+    _REQUEST_EXCEPTIONS += (httpx.HTTPError,)
+
+
+@contextmanager
+def poll_client():
+    """Yield an HTTP client for batched status polls.
+
+    If httpx with HTTP/2 support is installed, all GETs of a poll cycle are
+    multiplexed over a single TCP+TLS connection; otherwise the shared pooled
+    session is used.
+    """
+    if httpx is not None:
+        with httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0]),
+        ) as client:
+            yield client
+    else:
+        yield _SESSION
+
+
+def _get(session, url, headers):
+    if httpx is not None and isinstance(session, httpx.Client):
+        # httpx clients carry their timeout configuration themselves
+        return session.get(url, headers=headers)
+    return session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+
+
+_MSISDN_FIELD = None
+
+
+def _msisdn_field():
+    # Built once and copied per request, as the widget constructor walks the
+    # phonenumbers metadata for its prefix choices on every instantiation.
+    global _MSISDN_FIELD
+    if _MSISDN_FIELD is None:
+        field = PhoneNumberField(
+            label=_("Phone number"),
+            required=True,
+            widget=WrappedPhoneNumberPrefixWidget(),
+        )
+        field._required = field.required
+        field.required = False
+        field.widget.is_required = False
+        _MSISDN_FIELD = field
+    field = copy.copy(_MSISDN_FIELD)
+    field.widget = copy.copy(_MSISDN_FIELD.widget)
+    return field
+
+
 ENVIRONMENTS = (
     ("sandbox", "Sandbox"),
     ("mtnuganda", "MTN Uganda"),
@@ -44,31 +145,47 @@ ENVIRONMENTS = (
 )
 
 
-def get_token(base_url, subscription_key, api_user_id, api_secret, api="collection"):
-    # Then we get all the items that make up the current credentials and create a hash to detect changes
-    checksum = hashlib.sha256(
+@lru_cache(maxsize=64)
+def _credentials_checksum(subscription_key, api_user_id, api_secret, api):
+    # Hash over all items that make up the current credentials to detect changes
+    return hashlib.sha256(
         "".join([subscription_key, api_user_id, api_secret, api]).encode()
     ).hexdigest()
+
+
+def get_token(base_url, subscription_key, api_user_id, api_secret, api="collection"):
+    checksum = _credentials_checksum(subscription_key, api_user_id, api_secret, api)
     cache_key_hash = f"pretix_mtn_momo_token_hash_{checksum}"
+    token_url = base_url.rstrip("/") + f"/{api}/token/"
     token_hash = cache.get(cache_key_hash)
 
     if token_hash:
-        return token_hash["access_token"]
-
-    r = requests.post(
-        urljoin(
-            base_url,
-            f"/{api}/token/",
-        ),
+        remaining = token_hash.get("expires_at", 0) - time.time()
+        if remaining >= 120:
+            return token_hash["access_token"]
+        if remaining > 0 and not cache.add(
+            f"pretix_mtn_momo_token_lock_{checksum}", 1, timeout=10
+        ):
+            # Another process is already refreshing, the old token is still good
+            # for a while, so keep using it instead of stampeding the endpoint.
+            return token_hash["access_token"]
+
+    r = _SESSION.post(
+        token_url,
         auth=(api_user_id, api_secret),
         headers={
             "Ocp-Apim-Subscription-Key": subscription_key,
         },
+        timeout=REQUEST_TIMEOUT,
     )
     r.raise_for_status()
-    token_hash = r.json()
+    d = r.json()
+    token_hash = {
+        "access_token": d["access_token"],
+        "expires_at": time.time() + d["expires_in"],
+    }
 
-    cache.set(cache_key_hash, token_hash, token_hash["expires_in"] - 120)
+    cache.set(cache_key_hash, token_hash, d["expires_in"])
     return token_hash["access_token"]
 
 
@@ -126,6 +243,10 @@ class MTNMoMo(BasePaymentProvider):
     def __init__(self, event: Event):
         super().__init__(event)
         self.settings = SettingsSandbox("payment", "mtn_momo", event)
+        base = (self.settings.baseurl or "").rstrip("/")
+        self._url_requesttopay = base + "/collection/v1_0/requesttopay"
+        self._url_refund_status = base + "/disbursement/v1_0/refund"
+        self._url_refund = base + "/disbursement/v2_0/refund"
 
     def payment_refund_supported(self, payment: OrderPayment) -> bool:
         return self.settings.refund_subscription_key
@@ -142,7 +263,7 @@ class MTNMoMo(BasePaymentProvider):
         d = obj.info_data
         d["payer"] = {"_shredded": True}
         d["_shredded"] = True
-        obj.info = json.dumps(d)
+        obj.info = _json_dumps(d)
         obj.save(update_fields=["info"])
 
     def test_mode_message(self) -> str:
@@ -162,7 +283,7 @@ class MTNMoMo(BasePaymentProvider):
 
     def payment_control_render(self, request, payment) -> str:
         if payment.info:
-            payment_info = json.loads(payment.info)
+            payment_info = _json_loads(payment.info)
         else:
             payment_info = None
         template = get_template("pretix_mtn_momo/control.html")
@@ -180,11 +301,12 @@ class MTNMoMo(BasePaymentProvider):
         return bool(request.session.get("payment_mtn_momo_msisdn"))
 
     def payment_form(self, request: HttpRequest):
-        initial = {
-            k.replace("payment_%s_" % self.identifier, ""): v
-            for k, v in request.session.items()
-            if k.startswith("payment_%s_" % self.identifier)
-        }
+        initial = {}
+        if "payment_mtn_momo_msisdn" in request.session:
+            # lstrip for sessions written before the plus-less format change
+            initial["msisdn"] = "+" + request.session["payment_mtn_momo_msisdn"].lstrip(
+                "+"
+            )
 
         if not initial.get("msisdn"):
             cs = cart_session(request)
@@ -207,18 +329,7 @@ class MTNMoMo(BasePaymentProvider):
             prefix="payment_%s" % self.identifier,
             initial=initial,
         )
-        form.fields = {
-            "msisdn": PhoneNumberField(
-                label=_("Phone number"),
-                required=True,
-                widget=WrappedPhoneNumberPrefixWidget(),
-            )
-        }
-
-        for k, v in form.fields.items():
-            v._required = v.required
-            v.required = False
-            v.widget.is_required = False
+        form.fields = {"msisdn": _msisdn_field()}
 
         return form
 
@@ -228,9 +339,11 @@ class MTNMoMo(BasePaymentProvider):
     def checkout_prepare(self, request, cart):
         form = self.payment_form(request)
         if form.is_valid():
+            # The MTN API expects the E164 number without the leading "+", so we
+            # store it in that form right away.
             request.session["payment_mtn_momo_msisdn"] = phonenumbers.format_number(
                 form.cleaned_data["msisdn"], phonenumbers.PhoneNumberFormat.E164
-            )
+            ).lstrip("+")
             return True
         return False
 
@@ -250,23 +363,43 @@ class MTNMoMo(BasePaymentProvider):
             "request": request,
             "event": self.event,
             "settings": self.settings,
-            "msisdn": request.session["payment_mtn_momo_msisdn"],
+            "msisdn": "+" + request.session["payment_mtn_momo_msisdn"].lstrip("+"),
         }
         return template.render(ctx)
 
-    def _update_payment(self, payment: OrderPayment):
+    def _collection_token(self):
+        return get_token(
+            self.settings.baseurl,
+            self.settings.subscription_key,
+            self.settings.api_user_id,
+            self.settings.api_secret,
+        )
+
+    def _disbursement_token(self):
+        return get_token(
+            self.settings.baseurl,
+            self.settings.refund_subscription_key,
+            self.settings.api_user_id,
+            self.settings.api_secret,
+            api="disbursement",
+        )
+
+    def _update_payment(self, payment: OrderPayment, session=_SESSION):
+        try:
+            access_token = self._collection_token()
+        except requests.exceptions.RequestException:
+            logger.exception("Could not update payment state.")
+            return
+        self._update_payment_with_token(payment, access_token, session=session)
+
+    def _update_payment_with_token(
+        self, payment: OrderPayment, access_token, session=_SESSION
+    ):
         reference = payment.info_data["reference"]
         try:
-            access_token = get_token(
-                self.settings.baseurl,
-                self.settings.subscription_key,
-                self.settings.api_user_id,
-                self.settings.api_secret,
-            )
-            r = requests.get(
-                urljoin(
-                    self.settings.baseurl, f"/collection/v1_0/requesttopay/{reference}"
-                ),
+            r = _get(
+                session,
+                f"{self._url_requesttopay}/{reference}",
                 headers={
                     "X-Target-Environment": self.settings.environment,
                     "Ocp-Apim-Subscription-Key": self.settings.subscription_key,
@@ -274,15 +407,11 @@ class MTNMoMo(BasePaymentProvider):
                 },
             )
             r.raise_for_status()
-        except requests.exceptions.RequestException:
+        except _REQUEST_EXCEPTIONS:
             logger.exception("Could not update payment state.")
         else:
             d = r.json()
 
-            if d["status"] == "SUCCESSFUL":
-                payment.info_data = {**payment.info_data, **d}
-                payment.save(update_fields=["info"])
-                payment.confirm()
             if d["status"] == "FAILED" and payment.state in (
                 OrderPayment.PAYMENT_STATE_CREATED,
                 OrderPayment.PAYMENT_STATE_PENDING,
@@ -291,21 +420,29 @@ class MTNMoMo(BasePaymentProvider):
             else:
                 payment.info_data = {**payment.info_data, **d}
                 payment.save(update_fields=["info"])
+                if d["status"] == "SUCCESSFUL":
+                    # confirm() triggers invoicing and emails, which should not
+                    # block the polling task or the webhook response
+                    transaction.on_commit(
+                        lambda: confirm_payment.apply_async(args=(payment.pk,))
+                    )
+
+    def _update_refund(self, refund: OrderRefund, session=_SESSION):
+        try:
+            access_token = self._disbursement_token()
+        except requests.exceptions.RequestException:
+            logger.exception("Could not update payment state.")
+            return
+        self._update_refund_with_token(refund, access_token, session=session)
 
-    def _update_refund(self, refund: OrderRefund):
+    def _update_refund_with_token(
+        self, refund: OrderRefund, access_token, session=_SESSION
+    ):
         reference = refund.info_data["reference"]
         try:
-            access_token = get_token(
-                self.settings.baseurl,
-                self.settings.refund_subscription_key,
-                self.settings.api_user_id,
-                self.settings.api_secret,
-                api="disbursement",
-            )
-            r = requests.get(
-                urljoin(
-                    self.settings.baseurl, f"/disbursement/v1_0/refund/{reference}"
-                ),
+            r = _get(
+                session,
+                f"{self._url_refund_status}/{reference}",
                 headers={
                     "X-Target-Environment": self.settings.environment,
                     "Ocp-Apim-Subscription-Key": self.settings.refund_subscription_key,
@@ -313,15 +450,11 @@ class MTNMoMo(BasePaymentProvider):
                 },
             )
             r.raise_for_status()
-        except requests.exceptions.RequestException:
+        except _REQUEST_EXCEPTIONS:
             logger.exception("Could not update payment state.")
         else:
             d = r.json()
 
-            if d["status"] == "SUCCESSFUL":
-                refund.info_data = {**refund.info_data, **d}
-                refund.save(update_fields=["info"])
-                refund.done()
             if d["status"] == "FAILED" and refund.state in (
                 OrderRefund.REFUND_STATE_CREATED,
                 OrderRefund.REFUND_STATE_TRANSIT,
@@ -330,21 +463,19 @@ class MTNMoMo(BasePaymentProvider):
             else:
                 refund.info_data = {**refund.info_data, **d}
                 refund.save(update_fields=["info"])
+                if d["status"] == "SUCCESSFUL":
+                    refund.done()
 
     def execute_payment(self, request: HttpRequest, payment: OrderPayment) -> str:
         refid = str(uuid.uuid4())
         payment.info_data = {"reference": refid}
-        payment.save(update_fields=["info"])
+        external_id = f"{self.event.slug.upper()}-{payment.full_id}"
+        event_name = str(self.event.name)
 
         try:
-            access_token = get_token(
-                self.settings.baseurl,
-                self.settings.subscription_key,
-                self.settings.api_user_id,
-                self.settings.api_secret,
-            )
-            r = requests.post(
-                urljoin(self.settings.baseurl, "/collection/v1_0/requesttopay"),
+            access_token = self._collection_token()
+            r = _SESSION.post(
+                self._url_requesttopay,
                 headers={
                     "X-Callback-Url": (
                         urljoin(
@@ -363,16 +494,19 @@ class MTNMoMo(BasePaymentProvider):
                 json={
                     "amount": str(payment.amount),
                     "currency": self.event.currency,
-                    "externalId": f"{self.event.slug.upper()}-{payment.full_id}",
+                    "externalId": external_id,
                     "payer": {
                         "partyIdType": "MSISDN",
+                        # lstrip for sessions written before the plus-less
+                        # format change
                         "partyId": request.session["payment_mtn_momo_msisdn"].lstrip(
                             "+"
                         ),
                     },
-                    "payerMessage": f"{self.event.slug.upper()}-{payment.full_id}",
-                    "payeeNote": str(self.event.name),
+                    "payerMessage": external_id,
+                    "payeeNote": event_name,
                 },
+                timeout=REQUEST_TIMEOUT,
             )
             r.raise_for_status()
         except requests.exceptions.RequestException as e:
@@ -391,24 +525,18 @@ class MTNMoMo(BasePaymentProvider):
         else:
             del request.session["payment_mtn_momo_msisdn"]
             payment.state = OrderPayment.PAYMENT_STATE_PENDING
-            payment.save(update_fields=["state"])
-        self._update_payment(payment)
+            payment.save(update_fields=["info", "state"])
 
     def execute_refund(self, refund: OrderRefund):
         refid = str(uuid.uuid4())
         refund.info_data = {"reference": refid}
-        refund.save(update_fields=["info"])
+        external_id = f"{self.event.slug.upper()}-{refund.full_id}"
+        event_name = str(self.event.name)
 
         try:
-            access_token = get_token(
-                self.settings.baseurl,
-                self.settings.refund_subscription_key,
-                self.settings.api_user_id,
-                self.settings.api_secret,
-                api="disbursement",
-            )
-            r = requests.post(
-                urljoin(self.settings.baseurl, "/disbursement/v2_0/refund"),
+            access_token = self._disbursement_token()
+            r = _SESSION.post(
+                self._url_refund,
                 headers={
                     "X-Callback-Url": (
                         urljoin(
@@ -427,15 +555,18 @@ class MTNMoMo(BasePaymentProvider):
                 json={
                     "amount": str(refund.amount),
                     "currency": self.event.currency,
-                    "externalId": f"{self.event.slug.upper()}-{refund.full_id}",
+                    "externalId": external_id,
                     "referenceIdToRefund": refund.payment.info_data["reference"],
-                    "payerMessage": f"{self.event.slug.upper()}-{refund.full_id}",
-                    "payeeNote": str(self.event.name),
+                    "payerMessage": external_id,
+                    "payeeNote": event_name,
                 },
+                timeout=REQUEST_TIMEOUT,
             )
             r.raise_for_status()
-        except requests.exceptions.RequestException:
+        except requests.exceptions.RequestException as e:
             logger.exception("Could not execute refund.")
+            refund.info_data = {"reference": refid, "error": str(e)}
+            refund.save(update_fields=["info"])
             raise PaymentException(
                 _(
                     "We had trouble communicating with the payment service. Please try again and"
@@ -444,13 +575,17 @@ class MTNMoMo(BasePaymentProvider):
             )
         else:
             refund.state = OrderRefund.REFUND_STATE_TRANSIT
-            refund.save(update_fields=["state"])
+            refund.save(update_fields=["info", "state"])
         self._update_refund(refund)
 
     def payment_pending_render(
         self, request: HttpRequest, payment: OrderPayment
     ) -> str:
-        if payment.state == OrderPayment.PAYMENT_STATE_PENDING:
+        if payment.state == OrderPayment.PAYMENT_STATE_PENDING and cache.add(
+            f"pretix_mtn_momo_poll_{payment.pk}", 1, timeout=15
+        ):
+            # Debounce page refreshes to one poll per payment every 15 seconds;
+            # the periodic task and the webhook cover everything else.
             check_payment.apply_async(args=(payment.pk,))
 
         if payment.info:
@@ -3,13 +3,21 @@ from datetime import timedelta
 from django.dispatch import receiver
 from django.utils.timezone import now
 from django_scopes import scopes_disabled
+from itertools import islice
 from pretix.base.models import OrderPayment, OrderRefund
 from pretix.base.settings import settings_hierarkey
 from pretix.base.signals import periodic_task, register_payment_providers
 
-from .tasks import check_payment, check_refund
+from .tasks import check_payments_batch, check_refunds_batch
 
 logger = logging.getLogger(__name__)
+BATCH_SIZE = 50
+
+
+def _pk_batches(qs):
+    it = qs.values_list("pk", flat=True).iterator(chunk_size=500)
+    while batch := list(islice(it, BATCH_SIZE)):
+        yield batch
 
 
 @receiver(register_payment_providers, dispatch_uid="payment_mtn_momo")
@@ -22,19 +30,23 @@ def register_payment_provider(sender, **kwargs):
 @receiver(periodic_task, dispatch_uid="payment_mtn_momo_periodic")
 @scopes_disabled()
 def register_periodic_task(sender, **kwargs):
-    for op in OrderPayment.objects.filter(
-        provider="mtn_momo",
-        state=OrderPayment.PAYMENT_STATE_PENDING,
-        created__gt=now() - timedelta(days=1),
+    for batch in _pk_batches(
+        OrderPayment.objects.filter(
+            provider="mtn_momo",
+            state=OrderPayment.PAYMENT_STATE_PENDING,
+            created__gt=now() - timedelta(days=1),
+        )
     ):
-        check_payment.apply_async(args=(op.pk,))
-
-    for r in OrderRefund.objects.filter(
-        provider="mtn_momo",
-        state=OrderRefund.REFUND_STATE_TRANSIT,
-        created__gt=now() - timedelta(days=1),
+        check_payments_batch.apply_async(args=(batch,))
+
+    for batch in _pk_batches(
+        OrderRefund.objects.filter(
+            provider="mtn_momo",
+            state=OrderRefund.REFUND_STATE_TRANSIT,
+            created__gt=now() - timedelta(days=1),
+        )
     ):
-        check_refund.apply_async(args=(r.pk,))
+        check_refunds_batch.apply_async(args=(batch,))
 
 
 settings_hierarkey.add_default(
@@ -1,17 +1,117 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections
 from django_scopes import scopes_disabled
 from pretix.base.models import OrderPayment, OrderRefund
 from pretix.celery_app import app
 
+logger = logging.getLogger(__name__)
+
 
 @app.task
 @scopes_disabled()
 def check_payment(payment_id: int):
-    p = OrderPayment.objects.get(pk=payment_id)
+    p = OrderPayment.objects.select_related("order", "order__event").get(pk=payment_id)
     p.payment_provider._update_payment(p)
 
 
+@app.task
+@scopes_disabled()
+def confirm_payment(payment_id: int):
+    p = OrderPayment.objects.select_related("order", "order__event").get(pk=payment_id)
+    if p.state not in (
+        OrderPayment.PAYMENT_STATE_CONFIRMED,
+        OrderPayment.PAYMENT_STATE_REFUNDED,
+    ):
+        p.confirm()
+
+
 @app.task
 @scopes_disabled()
 def check_refund(refund_id: int):
-    r = OrderRefund.objects.get(pk=refund_id)
+    r = OrderRefund.objects.select_related("order", "order__event", "payment").get(
+        pk=refund_id
+    )
     r.payment_provider._update_refund(r)
+
+
+@app.task
+@scopes_disabled()
+def check_payments_batch(payment_ids: list):
+    from .payment import poll_client
+
+    def _check(prov, p, token, client):
+        try:
+            with scopes_disabled():
+                prov._update_payment_with_token(p, token, session=client)
+        finally:
+            # Connections opened by pool threads are not managed by Django's
+            # request/task lifecycle, so close them before the thread is reused
+            connections.close_all()
+
+    payments = list(
+        OrderPayment.objects.filter(
+            provider="mtn_momo", pk__in=payment_ids
+        ).select_related("order", "order__event")
+    )
+    # Resolve each event's access token once instead of per payment
+    tokens = {}
+    with poll_client() as client, ThreadPoolExecutor(max_workers=16) as pool:
+        futures = []
+        for p in payments:
+            prov = p.payment_provider
+            event_id = p.order.event_id
+            if event_id not in tokens:
+                try:
+                    tokens[event_id] = prov._collection_token()
+                except Exception:
+                    logger.exception("Could not update payment state.")
+                    tokens[event_id] = None
+            if tokens[event_id] is not None:
+                futures.append(pool.submit(_check, prov, p, tokens[event_id], client))
+        for f in futures:
+            try:
+                f.result()
+            except Exception:
+                logger.exception("Could not update payment state.")
+
+
+@app.task
+@scopes_disabled()
+def check_refunds_batch(refund_ids: list):
+    from .payment import poll_client
+
+    def _check(prov, r, token, client):
+        try:
+            with scopes_disabled():
+                prov._update_refund_with_token(r, token, session=client)
+        finally:
+            # Connections opened by pool threads are not managed by Django's
+            # request/task lifecycle, so close them before the thread is reused
+            connections.close_all()
+
+    refunds = list(
+        OrderRefund.objects.filter(
+            provider="mtn_momo", pk__in=refund_ids
+        ).select_related("order", "order__event", "payment")
+    )
+    # Resolve each event's access token once instead of per refund
+    tokens = {}
+    with poll_client() as client, ThreadPoolExecutor(max_workers=16) as pool:
+        futures = []
+        for r in refunds:
+            prov = r.payment_provider
+            event_id = r.order.event_id
+            if event_id not in tokens:
+                try:
+                    tokens[event_id] = prov._disbursement_token()
+                except Exception:
+                    logger.exception("Could not update refund state.")
+                    tokens[event_id] = None
+            if tokens[event_id] is not None:
+                futures.append(pool.submit(_check, prov, r, tokens[event_id], client))
+        for f in futures:
+            try:
+                f.result()
+            except Exception:
+                logger.exception("Could not update refund state.")
@@ -8,14 +8,22 @@ from pretix.base.models import OrderPayment, OrderRefund
 @scopes_disabled()
 def webhook(request):
     if "payment" in request.GET:
-        for op in OrderPayment.objects.filter(
-            provider="mtn_momo", pk=request.GET.get("payment")
-        ):
+        try:
+            op = OrderPayment.objects.select_related("order", "order__event").get(
+                provider="mtn_momo", pk=request.GET["payment"]
+            )
+        except (OrderPayment.DoesNotExist, ValueError):
+            pass
+        else:
             op.payment_provider._update_payment(op)
     elif "refund" in request.GET:
-        for r in OrderRefund.objects.filter(
-            provider="mtn_momo", pk=request.GET.get("refund")
-        ):
+        try:
+            r = OrderRefund.objects.select_related("order", "order__event").get(
+                provider="mtn_momo", pk=request.GET["refund"]
+            )
+        except (OrderRefund.DoesNotExist, ValueError):
+            pass
+        else:
             r.payment_provider._update_refund(r)
 
     return HttpResponse("OK")